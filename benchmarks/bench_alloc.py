@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# @file bench_alloc.py
+# @brief Memory allocated per SOAP call, from sending request to decoded
+#        response body.
+#
+# A local device answers every request with the same response with a
+# large non-ASCII TrackMetaData. Peak of memory traced by tracemalloc
+# is reported per call.
+#
+# requires python 3.9+ (tracemalloc.reset_peak)
+#
+# usage: bench_alloc.py [--calls <n>] [--size <kilobytes of metadata>]
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dlnap'))
+import dlnap
+
+REQUEST = (b'POST /av HTTP/1.1\r\nHOST: 127.0.0.1\r\n\r\n'
+           b'<s:Envelope></s:Envelope>')
+
+
+def build_response(size):
+    """ GetPositionInfo response with about 'size' kilobytes of metadata.
+   """
+    text = u'Привет мир ü '
+    metadata = text * (size * 1024 // len(text.encode('utf-8')))
+    body = (u'<?xml version="1.0" encoding="utf-8"?>'
+            u'<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+            u'<s:Body><u:GetPositionInfoResponse xmlns:u="urn:schemas-upnp-'
+            u'org:service:AVTransport:1"><TrackMetaData>{}</TrackMetaData>'
+            u'</u:GetPositionInfoResponse></s:Body></s:Envelope>').format(
+                metadata).encode('utf-8')
+    return ('HTTP/1.1 200 OK\r\nContent-Type: text/xml; charset="utf-8"\r\n'
+            'Content-Length: {}\r\n\r\n'.format(len(body))).encode(
+                'ascii') + body
+
+
+def serve(response):
+    """ Answer every request on a local port with response.
+
+   return -- port
+   """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+
+    def loop():
+        while True:
+            connection, address = server.accept()
+            data = b''
+            while b'</s:Envelope>' not in data:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            connection.sendall(response)
+            connection.close()
+
+    thread = threading.Thread(target=loop)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def call(port):
+    raw = dlnap._send_tcp(('127.0.0.1', port), REQUEST)
+    status, headers, body = dlnap._split_response(raw)
+    return dlnap._decode_body(headers, body)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--size', type=int, default=64,
+                        help='kilobytes of metadata in response')
+    args = parser.parse_args()
+
+    response = build_response(args.size)
+    port = serve(response)
+    call(port)
+
+    tracemalloc.start()
+    peak = 0
+    started = time.time()
+    for i in range(args.calls):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        call(port)
+        peak += tracemalloc.get_traced_memory()[1] - base
+    elapsed = time.time() - started
+    tracemalloc.stop()
+
+    print('{} byte response: {:.1f} KB peak per call, {:.2f} ms per '
+          'call'.format(len(response), peak / 1024.0 / args.calls,
+                        elapsed * 1000 / args.calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# @file bench_transcode.py
+# @brief Throughput of TranscodeServer, converting through ffmpeg and from
+#        cache.
+#
+# Media is requested the way a renderer does, over http from a running
+# TranscodeServer. The first request pipes the source through ffmpeg, the
+# second one is served from the converted copy in cache.
+#
+# usage: bench_transcode.py [--source <media file>] [--profile <mime type>]
+#                           [--ffmpeg <ffmpeg executable>]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dlnap'))
+import dlnap
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+class Renderer:
+    """ Device accepting only one media type.
+   """
+
+    ip = '127.0.0.1'
+    port = 80
+
+    def __init__(self, mime_type):
+        self.mime_type = mime_type
+
+    def sink_mime_types(self):
+        return [self.mime_type]
+
+    def __repr__(self):
+        return 'renderer of {}'.format(self.mime_type)
+
+
+def fetch(url, chunk_size=64 * 1024):
+    """ Read url to the end.
+
+   return -- (bytes read, seconds to first byte, seconds total)
+   """
+    started = time.time()
+    response = urlopen(url)
+    first = None
+    size = 0
+    while True:
+        chunk = response.read(chunk_size)
+        if first is None:
+            first = time.time() - started
+        if not chunk:
+            break
+        size += len(chunk)
+    return size, first, time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', help='media to convert, 60 s of '
+                        'generated flac audio by default')
+    parser.add_argument('--profile', default='audio/mpeg',
+                        help='mime type renderer accepts')
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='dlnap-bench-')
+    try:
+        source = args.source
+        if source is None:
+            source = os.path.join(work_dir, 'source.flac')
+            try:
+                subprocess.check_call([
+                    args.ffmpeg, '-nostdin', '-loglevel', 'error', '-f',
+                    'lavfi', '-i', 'sine=frequency=440:duration=60', source
+                ])
+            except OSError:
+                print('{} is not available, nothing to measure.'.format(
+                    args.ffmpeg))
+                return
+
+        server = dlnap.TranscodeServer(
+            port=0,
+            cache_dir=os.path.join(work_dir, 'cache'),
+            ffmpeg=args.ffmpeg)
+        url, metadata = server.serve(Renderer(args.profile), source)
+        server.start()
+        try:
+            for label in ('ffmpeg', 'cache'):
+                size, first, total = fetch(url)
+                print('{:<7} {:.1f} MB in {:.2f} s, {:.1f} MB/s, first byte '
+                      '{:.1f} ms'.format(label, size / 1e6, total,
+                                         size / 1e6 / total, first * 1000))
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# @file bench_ttff.py
+# @brief Time-to-first-frame with and without generated DIDL-Lite metadata.
+#
+# A local renderer model receives SetAVTransportURI and Play. Without
+# metadata it probes the media url first (range request for the head of the
+# file), the way most renderers sniff unknown media, with metadata it starts
+# playback right away. Media is served with a configurable first byte
+# latency, so the cost of the extra round trip is visible.
+#
+# usage: bench_ttff.py [--runs <n>] [--latency <seconds>]
+
+import os
+import re
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dlnap'))
+import dlnap
+
+try:
+    from urllib.request import urlopen, Request
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    from urllib2 import urlopen, Request
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+PROBE_SIZE = 64 * 1024
+MEDIA = os.urandom(1024 * 1024)
+
+DESCRIPTION = b'''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0"><device>
+<friendlyName>TTFF renderer</friendlyName><serviceList><service>
+<serviceType>urn:schemas-upnp-org:service:AVTransport:1</serviceType>
+<controlURL>/av</controlURL></service></serviceList></device></root>'''
+
+RESPONSE = '''<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<u:{0}Response xmlns:u="urn:schemas-upnp-org:service:AVTransport:1"/>
+</s:Body></s:Envelope>'''
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """ Serves MEDIA after server latency, honours open ended ranges.
+   """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        start, end = 0, len(MEDIA) - 1
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            start, end = int(first), int(last or end)
+        self.send_response(206 if 'Range' in self.headers else 200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', end - start + 1)
+        self.end_headers()
+        try:
+            self.wfile.write(MEDIA[start:end + 1])
+        except (IOError, OSError):
+            pass
+
+
+class RendererHandler(BaseHTTPRequestHandler):
+    """ Device description and AVTransport of renderer model.
+   """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', len(DESCRIPTION))
+        self.end_headers()
+        self.wfile.write(DESCRIPTION)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        action = self.headers['SOAPACTION'].strip('"').split('#')[1]
+        renderer = self.server
+        if action == 'SetAVTransportURI':
+            renderer.url = re.search(b'<CurrentURI>(.*?)</CurrentURI>',
+                                     body).group(1).decode('utf-8')
+            renderer.probe = b'CurrentURIMetaData>&lt;DIDL' not in body
+        elif action == 'Play':
+            renderer.playing = threading.Thread(target=self.first_frame)
+            renderer.playing.start()
+        response = RESPONSE.format(action).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def first_frame(self):
+        renderer = self.server
+        if renderer.probe:
+            # find out media type from the head of the file
+            request = Request(
+                renderer.url,
+                headers={'Range': 'bytes=0-{}'.format(PROBE_SIZE - 1)})
+            urlopen(request).read()
+        stream = urlopen(renderer.url)
+        stream.read(4096)
+        renderer.first_frame = time.time()
+        stream.close()
+
+
+def measure(device, renderer, url, metadata, runs):
+    """ Time from SetAVTransportURI to the first media bytes on renderer.
+
+   return -- sorted list of seconds
+   """
+    results = []
+    for i in range(runs):
+        started = time.time()
+        device.set_current_media(url, metadata=metadata)
+        device.play()
+        renderer.playing.join()
+        results.append(renderer.first_frame - started)
+    return sorted(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='first byte latency of media server, seconds')
+    args = parser.parse_args()
+
+    media = dlnap._ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    media.latency = args.latency
+    renderer = dlnap._ThreadingHTTPServer(('127.0.0.1', 0), RendererHandler)
+    for server in (media, renderer):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    raw = 'HTTP/1.1 200 OK\r\nLOCATION: http://127.0.0.1:{}/\r\n\r\n'.format(
+        renderer.server_address[1]).encode('ascii')
+    device = dlnap.DlnapDevice(raw, '127.0.0.1')
+    url = 'http://127.0.0.1:{}/clip.mp4'.format(media.server_address[1])
+
+    for label, metadata in (('without metadata', ''), ('with metadata', None)):
+        results = measure(device, renderer, url, metadata, args.runs)
+        print('{:<17} p50 {:.1f} ms  max {:.1f} ms'.format(
+            label, results[len(results) // 2] * 1000, results[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -31,21 +31,38 @@ import time
 import signal
 import socket
 import select
+import random
 import logging
 import traceback
+import hashlib
+import tempfile
 import mimetypes
+import subprocess
+import json
+import codecs
+import collections
 from contextlib import contextmanager
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
 
+import io
 import os
 py3 = sys.version_info[0] == 3
 if py3:
     from urllib.request import urlopen
+    from urllib.parse import urlparse, unquote
     from http.server import HTTPServer
     from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    import queue
 else:
     from urllib2 import urlopen
+    from urlparse import urlparse
+    from urllib import unquote
     from BaseHTTPServer import BaseHTTPRequestHandler
     from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
 
 import shutil
 import threading
@@ -57,8 +74,55 @@ URN_AVTransport_Fmt = "urn:schemas-upnp-org:service:AVTransport:{}"
 URN_RenderingControl = "urn:schemas-upnp-org:service:RenderingControl:1"
 URN_RenderingControl_Fmt = "urn:schemas-upnp-org:service:RenderingControl:{}"
 
+URN_ContentDirectory_Fmt = "urn:schemas-upnp-org:service:ContentDirectory:{}"
+URN_MediaServer_Fmt = "urn:schemas-upnp-org:device:MediaServer:{}"
+
+URN_ConnectionManager_Fmt = "urn:schemas-upnp-org:service:ConnectionManager:{}"
+
 SSDP_ALL = "ssdp:all"
 
+# seconds to wait for a device description before giving up on the device
+DESCRIPTION_TIMEOUT = 3
+
+# media types renderers care about, missing in some mimetypes tables
+for _mime, _ext in (('video/x-matroska', '.mkv'), ('video/mp2t', '.ts'),
+                    ('audio/flac', '.flac'), ('audio/mp4', '.m4a')):
+    mimetypes.add_type(_mime, _ext)
+
+# DLNA.ORG_PN profiles that are fully defined by the mime type
+DLNA_PROFILES = {
+    'audio/mpeg': 'MP3',
+    'audio/L16': 'LPCM',
+    'audio/x-ms-wma': 'WMABASE',
+    'image/jpeg': 'JPEG_LRG',
+    'image/png': 'PNG_LRG',
+    'image/gif': 'GIF_LRG',
+}
+# DLNA.ORG_FLAGS: streaming transfer mode, background transfer mode,
+# connection stall, DLNA v1.5
+DLNA_FLAGS_STREAMING = '01700000000000000000000000000000'
+# DLNA.ORG_FLAGS: interactive transfer mode, background transfer mode,
+# DLNA v1.5
+DLNA_FLAGS_INTERACTIVE = '00D00000000000000000000000000000'
+
+# Formats TranscodeServer converts media to, in order of preference.
+# (mime type, file extension, ffmpeg output arguments)
+TRANSCODE_PROFILES = [
+    ('video/mp2t', '.ts', ['-c:v', 'copy', '-c:a', 'aac', '-f', 'mpegts']),
+    ('video/vnd.dlna.mpeg-tts', '.ts',
+     ['-c:v', 'copy', '-c:a', 'aac', '-f', 'mpegts']),
+    ('video/mp4', '.mp4', [
+        '-c:v', 'copy', '-c:a', 'aac', '-movflags', 'frag_keyframe+empty_moov',
+        '-f', 'mp4'
+    ]),
+    ('video/mpeg', '.mpg',
+     ['-c:v', 'mpeg2video', '-q:v', '3', '-c:a', 'mp2', '-f', 'vob']),
+    ('audio/mpeg', '.mp3', ['-vn', '-c:a', 'libmp3lame', '-q:a', '2', '-f',
+                            'mp3']),
+    ('audio/wav', '.wav', ['-vn', '-c:a', 'pcm_s16le', '-f', 'wav']),
+    ('audio/x-wav', '.wav', ['-vn', '-c:a', 'pcm_s16le', '-f', 'wav']),
+]
+
 
 # =================================================================================================
 # XML to DICT
@@ -240,27 +304,60 @@ def _get_port(location):
     return int(port[0]) if port else 80
 
 
-def _get_control_url(xml, urn):
-    """ Extract AVTransport contol url from device description xml
+def _get_service_version(urn):
+    """ Extract version from service or device urn.
+
+   urn -- string like urn:schemas-upnp-org:service:AVTransport:2
+   return -- version number or None if urn has no version
+   """
+    version = re.findall(r'^urn:.*:(\d+)$', urn)
+    return int(version[0]) if version else None
+
+
+def _find_service(xml, urn_fmt):
+    """ Find the highest version of service in device description xml.
 
    xml -- device description xml
-   return -- control url or empty string if wasn't found
+   urn_fmt -- service urn format, e.g. URN_AVTransport_Fmt
+   return -- (version, control url) pair or (None, None) if wasn't found
    """
-    return _xpath(
-        xml,
-        'root/device/serviceList/service@serviceType={}/controlURL'.format(
-            urn))
+    found = (None, None)
+    service_list = _xpath(xml, 'root/device/serviceList')
+    if not isinstance(service_list, dict):
+        return found
+
+    prefix = urn_fmt.format('')
+    for service in service_list.get('service', []):
+        urn = (service.get('serviceType') or [''])[0]
+        version = _get_service_version(urn)
+        if not urn.startswith(prefix) or version is None:
+            continue
+        if found[0] is None or version > found[0]:
+            control_url = service.get('controlURL')
+            found = (version, control_url[0] if control_url else None)
+    return found
+
+
+# SessionRecorder that logs SSDP and SOAP exchanges, see SessionRecorder.start
+_recorder = None
 
 
 @contextmanager
-def _send_udp(to, packet):
-    """ Send UDP message to group
+def _send_udp(to, packets):
+    """ Send UDP messages to group
 
-   to -- (host, port) group to send the packet to
-   packet -- message to send
+   to -- (host, port) group to send the packets to
+   packets -- message bytes or list of messages to send
    """
+    if not isinstance(packets, (list, tuple)):
+        packets = [packets]
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.sendto(packet.encode(), to)
+    for packet in packets:
+        if not isinstance(packet, bytes):
+            packet = packet.encode()
+        sock.sendto(packet, to)
+        if _recorder is not None:
+            _recorder.record('ssdp', to, packet)
     yield sock
     sock.close()
 
@@ -271,45 +368,377 @@ def _unescape_xml(xml):
     return xml.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
 
 
-def _send_tcp(to, payload):
+class DlnapError(Exception):
+    """ Communication with device failed.
+   """
+
+
+class TransportError(DlnapError):
+    """ Device is unreachable or connection broke.
+   """
+
+
+class CircuitOpenError(DlnapError):
+    """ Device failed too many times in a row and is not called for a while.
+   """
+
+
+class DeadlineExceeded(DlnapError):
+    """ Operation didn't complete before its deadline.
+   """
+
+
+class UPnPError(DlnapError):
+    """ Device responded with UPnP fault.
+   """
+
+    def __init__(self, code, description):
+        super(UPnPError, self).__init__('UPnPError {}: {}'.format(
+            code, description))
+        self.code = code
+        self.description = description
+
+
+def _send_tcp(to, payload, connect_timeout=5, read_timeout=5, deadline=None):
     """ Send TCP message to group
 
    to -- (host, port) group to send to payload to
-   payload -- message to send
+   payload -- message bytes to send
+   connect_timeout -- seconds to wait for connection
+   read_timeout -- seconds to wait for each chunk of response
+   deadline -- absolute time the whole exchange must complete by
+   return -- raw response bytearray
    """
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+
+    def timeout(seconds):
+        if deadline is None:
+            return seconds
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('{}:{} no response before deadline'.format(
+                to[0], to[1]))
+        return min(seconds, remaining)
+
+    started = time.time()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
+        sock.settimeout(timeout(connect_timeout))
         sock.connect(to)
-        sock.sendall(payload.encode('utf-8'))
-
-        data = sock.recv(2048)
-        if py3:
-            data = data.decode('utf-8')
-        data = _xml2dict(_unescape_xml(data), True)
-
-        errorDescription = _xpath(
-            data,
-            's:Envelope/s:Body/s:Fault/detail/UPnPError/errorDescription')
-        if errorDescription is not None:
-            logging.error(errorDescription)
-    except Exception as e:
-        data = ''
+        sock.settimeout(timeout(read_timeout))
+        sock.sendall(payload)
+
+        # receive straight into one buffer, stop as soon as Content-Length
+        # bytes of body arrived instead of waiting for device to close
+        buf = bytearray(16384)
+        view = memoryview(buf)
+        size = 0
+        expected = None
+        while expected is None or size < expected:
+            if size == len(buf):
+                view.release()
+                buf.extend(bytearray(max(len(buf), (expected or 0) - size)))
+                view = memoryview(buf)
+            # device trickling bytes must not outlive the deadline
+            sock.settimeout(timeout(read_timeout))
+            try:
+                received = sock.recv_into(view[size:])
+            except socket.timeout:
+                # device keeping connection open after response of unknown
+                # size, truncated body of known size is still an error
+                if expected is not None or not _has_body(buf, size):
+                    raise
+                break
+            if not received:
+                break
+            size += received
+            if expected is None:
+                expected = _get_response_size(buf, size)
+        view.release()
+    except DeadlineExceeded as e:
+        if _recorder is not None:
+            _recorder.record('soap', to, payload, started=started, error=e)
+        raise
+    except (socket.error, socket.timeout) as e:
+        if _recorder is not None:
+            _recorder.record('soap', to, payload, started=started, error=e)
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlineExceeded('{}:{} no response before deadline'.format(
+                to[0], to[1]))
+        raise TransportError('{}:{} {}'.format(to[0], to[1], e))
     finally:
         sock.close()
+
+    del buf[size:]
+    if _recorder is not None:
+        _recorder.record('soap', to, payload, buf, started)
+    if not size:
+        raise TransportError('{}:{} empty response'.format(*to))
+    return buf
+
+
+def _get_response_size(buf, size):
+    """ Full size of HTTP response from its beginning.
+
+   buf -- received bytes
+   size -- number of received bytes in buf
+   return -- response size or None if it is not known yet or until close
+   """
+    end = buf.find(b'\r\n\r\n', 0, size)
+    if end < 0:
+        return None
+    if re.search(br'^transfer-encoding:[ \t]*chunked', buf[:end], re.M | re.I):
+        return _get_chunked_size(buf, end + 4, size)
+    length = re.search(br'^content-length:[ \t]*(\d+)', buf[:end], re.M | re.I)
+    if length is None:
+        return None
+    return end + 4 + int(length.group(1))
+
+
+def _get_chunked_size(buf, i, size):
+    """ Full size of HTTP response with chunked body.
+
+   buf -- received bytes
+   i -- offset of body in buf
+   size -- number of received bytes in buf
+   return -- response size or None until the last chunk is received
+   """
+    while True:
+        end = buf.find(b'\r\n', i, size)
+        if end < 0:
+            return None
+        try:
+            length = int(bytes(buf[i:end]).split(b';')[0], 16)
+        except ValueError:
+            # malformed, read until device closes connection
+            return None
+        if length == 0:
+            # last chunk is followed by optional trailers and empty line
+            trailer = buf.find(b'\r\n\r\n', end, size)
+            return trailer + 4 if trailer >= 0 else None
+        i = end + 2 + length + 2
+        if i > size:
+            return None
+
+
+def _has_body(buf, size):
+    """ Whether headers and part of body of HTTP response are received.
+   """
+    end = buf.find(b'\r\n\r\n', 0, size)
+    return 0 <= end and end + 4 < size
+
+
+def _split_response(raw):
+    """ Split raw HTTP response without copying its body.
+
+   raw -- raw response bytes
+   return -- (status code, headers dictionary with lower case names, body)
+   """
+    end = raw.find(b'\r\n\r\n')
+    if end < 0:
+        end = len(raw)
+    lines = raw[:end].split(b'\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower().decode('latin-1')] = \
+            value.strip().decode('latin-1')
+
+    body = memoryview(raw)[end + 4:]
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = _dechunk(body)
+    return _get_status(lines[0]), headers, body
+
+
+def _dechunk(body):
+    """ Join body sent with chunked transfer encoding.
+   """
+    data = body.tobytes()
+    chunks = []
+    i = 0
+    while True:
+        end = data.find(b'\r\n', i)
+        if end < 0:
+            break
+        try:
+            length = int(data[i:end].split(b';')[0], 16)
+        except ValueError:
+            break
+        if length == 0:
+            break
+        chunks.append(data[end + 2:end + 2 + length])
+        i = end + 2 + length + 2
+    return b''.join(chunks)
+
+
+def _decode_body(headers, body):
+    """ Decode response body according to its charset.
+   """
+    charset = re.findall(r'charset="?([\w-]+)', headers.get('content-type', ''))
+    return codecs.decode(body, charset[0] if charset else 'utf-8', 'replace')
+
+
+def _parse_response(raw):
+    """ Convert raw SOAP response to xml dictionary.
+
+   raw -- raw response bytes
+   return -- response xml dictionary
+   """
+    status, headers, body = _split_response(raw)
+    data = _xml2dict(_unescape_xml(_decode_body(headers, body)), True)
+
+    fault = _xpath(data, 's:Envelope/s:Body/s:Fault/detail/UPnPError')
+    if isinstance(fault, dict):
+        code = fault.get('errorCode')
+        description = fault.get('errorDescription')
+        raise UPnPError(code[0] if code else None,
+                        description[0] if description else '')
+
+    if status not in (None, 200):
+        raise DlnapError('HTTP status {}'.format(status))
     return data
 
 
+def _get_status(raw):
+    """ Extract status code from raw HTTP response.
+
+   raw -- raw response bytes
+   return -- status code or None if raw is not an HTTP response
+   """
+    status = re.match(br'HTTP/\d\.\d\s+(\d+)', raw)
+    return int(status.group(1)) if status else None
+
+
+IDEMPOTENT_ACTIONS = ('Stop', 'Seek')
+
+
+class CallPolicy:
+    """ Deadline, retry and circuit breaker policy of SOAP calls to device.
+
+   Only idempotent actions (Get* and IDEMPOTENT_ACTIONS) are retried.
+   After 'failure_threshold' transport failures in a row calls fail fast with
+   CircuitOpenError for 'reset_timeout' seconds, then one call is let through
+   to probe the device.
+   """
+
+    def __init__(self,
+                 deadline=10,
+                 connect_timeout=2,
+                 read_timeout=5,
+                 retries=2,
+                 backoff=0.2,
+                 failure_threshold=3,
+                 reset_timeout=30):
+        """ deadline -- overall seconds for a call including retries
+      connect_timeout -- seconds to wait for connection
+      read_timeout -- seconds to wait for each chunk of response
+      retries -- retries of idempotent actions
+      backoff -- base delay between retries, doubles on every retry
+      failure_threshold -- failures in a row to open the circuit
+      reset_timeout -- seconds before probing device again
+      """
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__opened_at = None
+        self.__probing = False
+
+    def is_idempotent(self, action):
+        return action.startswith('Get') or action in IDEMPOTENT_ACTIONS
+
+    def __allow(self):
+        with self.__lock:
+            if self.__opened_at is None:
+                return True
+            if self.__probing or \
+                    time.time() - self.__opened_at < self.reset_timeout:
+                return False
+            self.__probing = True
+            return True
+
+    def __succeeded(self):
+        with self.__lock:
+            self.__failures = 0
+            self.__opened_at = None
+            self.__probing = False
+
+    def __failed(self):
+        with self.__lock:
+            self.__failures += 1
+            if self.__probing or self.__failures >= self.failure_threshold:
+                self.__opened_at = time.time()
+            self.__probing = False
+
+    def send(self, to, packet, action):
+        """ Send packet to device according to the policy.
+
+      to -- (host, port) of device
+      packet -- packet to send
+      action -- control action of the packet
+      return -- raw response
+      """
+        if not self.__allow():
+            raise CircuitOpenError('{}:{} circuit is open'.format(*to))
+
+        deadline = time.time() + self.deadline
+        attempts = 1 + (self.retries if self.is_idempotent(action) else 0)
+        succeeded = False
+        try:
+            for attempt in range(attempts):
+                if deadline - time.time() <= 0:
+                    raise DeadlineExceeded('{}:{} {} not sent before deadline'.
+                                           format(to[0], to[1], action))
+                try:
+                    raw = _send_tcp(to, packet, self.connect_timeout,
+                                    self.read_timeout, deadline)
+                except TransportError as e:
+                    delay = self.backoff * 2**attempt * random.uniform(
+                        0.5, 1.5)
+                    if attempt + 1 == attempts or \
+                            time.time() + delay >= deadline:
+                        raise
+                    logging.info('{} failed, retrying: {}'.format(action, e))
+                    time.sleep(delay)
+                else:
+                    succeeded = True
+                    return raw
+        finally:
+            # any outcome ends a half-open probe
+            if succeeded:
+                self.__succeeded()
+            else:
+                self.__failed()
+
+
+def _get_header(raw, name):
+    """ Extract header value from discovery response
+
+    raw -- raw discovery response bytes
+    name -- case insensitive header name
+    return -- header value string
+    """
+    t = re.findall(br'^' + re.escape(name.encode('ascii')) +
+                   br':[ \t]*(.*?)\r?$', raw, re.M | re.I)
+    if len(t) > 0:
+        return t[0].strip().decode('utf-8', 'replace')
+    return ''
+
+
 def _get_location_url(raw):
     """ Extract device description url from discovery response
 
-    raw -- raw discovery response
+    raw -- raw discovery response bytes
     return -- location url string
     """
-    t = re.findall('\n(?i)location:\s*(.*)\r\s*', raw, re.M)
-    if len(t) > 0:
-        return t[0]
-    return ''
+    return _get_header(raw, 'location')
 
 
 def _get_friendly_name(xml):
@@ -335,6 +764,236 @@ def _get_serve_ip(target_ip, target_port=80):
     return my_ip
 
 
+def _get_response_value(xml, action, field):
+    """ Extract field value from action response xml.
+
+   xml -- response xml dictionary
+   action -- control action the response belongs to, e.g. GetPositionInfo
+   field -- field name, e.g. RelTime
+   return -- field value or None if field wasn't found
+   """
+    d = xml
+    for name in ('Envelope', 'Body', action + 'Response', field):
+        if not isinstance(d, dict):
+            return None
+        for tag, values in d.items():
+            if tag.split(':')[-1] == name:
+                d = values[0] if values else None
+                break
+        else:
+            return None
+    return d
+
+
+def _parse_time(value):
+    """ Convert time string to seconds.
+
+   value -- time string like H+:MM:SS[.F+]
+   return -- number of seconds or None if value is not a time
+   """
+    m = re.match(r'^\s*(\d+):(\d{1,2}):(\d{1,2}(?:\.\d+)?)\s*$', value or '')
+    if not m:
+        return None
+    return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+
+
+def _format_time(seconds):
+    """ Convert seconds to time string.
+
+   seconds -- number of seconds
+   return -- time string like HH:MM:SS
+   """
+    seconds = int(max(seconds, 0))
+    return '{:02}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60,
+                                      seconds % 60)
+
+
+class _LRUCache:
+    """ Thread safe dictionary keeping 'size' most recently used items.
+   """
+
+    def __init__(self, size):
+        self.size = size
+        self.__items = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key not in self.__items:
+                return default
+            value = self.__items.pop(key)
+            self.__items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__items.pop(key, None)
+            self.__items[key] = value
+            while len(self.__items) > self.size:
+                self.__items.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+
+def _protocol_info(mime_type, seekable=False):
+    """ Build protocolInfo of http resource.
+
+   mime_type -- mime type of resource
+   seekable -- resource supports byte range requests
+   return -- string like http-get:*:audio/mpeg:DLNA.ORG_PN=MP3;DLNA.ORG_OP=01;..
+   """
+    params = []
+    if mime_type in DLNA_PROFILES:
+        params.append('DLNA.ORG_PN={}'.format(DLNA_PROFILES[mime_type]))
+    params.append('DLNA.ORG_OP={}'.format('01' if seekable else '00'))
+    params.append('DLNA.ORG_FLAGS={}'.format(
+        DLNA_FLAGS_INTERACTIVE
+        if mime_type.startswith('image/') else DLNA_FLAGS_STREAMING))
+    return 'http-get:*:{}:{}'.format(mime_type, ';'.join(params))
+
+
+_didl_cache = _LRUCache(256)
+
+
+def _didl_metadata(url,
+                   path=None,
+                   title=None,
+                   mime_type=None,
+                   duration=None,
+                   seekable=False):
+    """ Build DIDL-Lite metadata for media url, so renderer doesn't have to
+   probe the url to find out media type.
+
+   url -- media url
+   path -- local file served at url, used for mime type and size
+   title -- media title, default is file name from url
+   mime_type -- media mime type, guessed from path or url if None
+   duration -- media duration in seconds if known
+   seekable -- url is known to support byte range requests, only true for
+               media served locally
+   return -- DIDL-Lite xml string or '' if mime type is unknown, so renderer
+             probes the url itself
+   """
+    key = (url, path, title, mime_type, duration, seekable)
+    didl = _didl_cache.get(key)
+    if didl is not None:
+        return didl
+
+    name = unquote(os.path.basename(urlparse(url).path))
+    if mime_type is None:
+        mime_type = mimetypes.guess_type(path or name)[0]
+    if mime_type is None:
+        # wrong metadata is worse than none, e.g. for videoplayback?.. urls
+        _didl_cache.put(key, '')
+        return ''
+    if title is None:
+        title = os.path.splitext(name)[0] or url
+
+    major = mime_type.split('/')[0]
+    upnp_class = {
+        'audio': 'object.item.audioItem.musicTrack',
+        'video': 'object.item.videoItem',
+        'image': 'object.item.imageItem.photo',
+    }.get(major, 'object.item')
+
+    res_attrs = 'protocolInfo={}'.format(
+        quoteattr(_protocol_info(mime_type, seekable)))
+    if path is not None and os.path.isfile(path):
+        res_attrs += ' size="{}"'.format(os.path.getsize(path))
+    if duration is not None:
+        res_attrs += ' duration="{}"'.format(_format_time(duration))
+
+    didl = ''.join([
+        '<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/"',
+        ' xmlns:dc="http://purl.org/dc/elements/1.1/"',
+        ' xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/"',
+        ' xmlns:dlna="urn:schemas-dlna-org:metadata-1-0/">',
+        '<item id="0" parentID="-1" restricted="1">',
+        '<dc:title>{}</dc:title>'.format(escape(title)),
+        '<upnp:class>{}</upnp:class>'.format(upnp_class),
+        '<res {}>{}</res>'.format(res_attrs, escape(url)),
+        '</item></DIDL-Lite>',
+    ])
+    _didl_cache.put(key, didl)
+    return didl
+
+
+def _local_name(tag):
+    """ Strip namespace from ElementTree tag.
+   """
+    return tag.rsplit('}', 1)[-1]
+
+
+def _parse_browse_response(raw, action):
+    """ Extract result of Browse or Search from raw response.
+
+   raw -- raw response bytes
+   action -- Browse or Search
+   return -- (DIDL-Lite string, number returned, total matches)
+   """
+    status, headers, body = _split_response(raw)
+    fields = {}
+    for elem in ElementTree.fromstring(body).iter():
+        name = _local_name(elem.tag)
+        if name in ('Result', 'NumberReturned', 'TotalMatches'):
+            fields[name] = elem.text or ''
+    if 'Result' not in fields:
+        raise DlnapError('{} response has no Result'.format(action))
+
+    def number(name):
+        value = fields.get(name, '').strip()
+        return int(value) if value.isdigit() else 0
+
+    return fields['Result'], number('NumberReturned'), number('TotalMatches')
+
+
+def _didl_object(elem):
+    """ Convert DIDL-Lite item or container element to dictionary.
+
+   elem -- ElementTree element
+   return -- dictionary like
+      { 'type': 'item', 'id': '64$1', 'parentID': '64', 'title': 'Song',
+        'class': 'object.item.audioItem.musicTrack',
+        'res': [ {'url': 'http://..', 'protocolInfo': 'http-get:*:audio/mpeg:*',
+                  'duration': '0:03:12.000'} ] }
+   """
+    obj = dict(elem.attrib)
+    obj['type'] = _local_name(elem.tag)
+    obj['res'] = []
+    for child in elem:
+        name = _local_name(child.tag)
+        if name == 'res':
+            res = dict(child.attrib)
+            res['url'] = (child.text or '').strip()
+            obj['res'].append(res)
+        elif name not in obj:
+            obj[name] = (child.text or '').strip()
+    return obj
+
+
+def _iter_didl(didl):
+    """ Parse DIDL-Lite incrementally.
+
+   didl -- DIDL-Lite xml string
+   return -- generator of _didl_object dictionaries
+   """
+    if not didl.strip():
+        return
+    depth = 0
+    for event, elem in ElementTree.iterparse(
+            io.BytesIO(didl.encode('utf-8')), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        # objects are direct children of DIDL-Lite root
+        if depth == 1 and _local_name(elem.tag) in ('item', 'container'):
+            yield _didl_object(elem)
+            elem.clear()
+
+
 class DlnapDevice:
     """ Represents DLNA/UPnP device.
    """
@@ -346,22 +1005,35 @@ class DlnapDevice:
 
         self.ip = ip
         self.ssdp_version = 1
+        self.rendering_control_version = 1
+        self.content_directory_version = 1
+        self.connection_manager_version = 1
 
         self.port = None
         self.name = 'Unknown'
         self.control_url = None
         self.rendering_control_url = None
+        self.content_directory_url = None
+        self.connection_manager_url = None
+        self.__sink_protocol_info = None
         self.has_av_transport = False
+        self.has_content_directory = False
+        self.browse_cache = _LRUCache(64)
+        self.__poller = None
+        self.policy = CallPolicy()
 
         try:
-            self.__raw = raw.decode()
+            self.__raw = raw
             self.location = _get_location_url(self.__raw)
             self.__logger.info('location: {}'.format(self.location))
 
             self.port = _get_port(self.location)
             self.__logger.info('port: {}'.format(self.port))
 
-            raw_desc_xml = urlopen(self.location).read().decode()
+            response = urlopen(self.location, timeout=DESCRIPTION_TIMEOUT)
+            raw_desc_xml = _decode_body({
+                'content-type': response.info().get('Content-Type', '')
+            }, response.read())
 
             self.__desc_xml = _xml2dict(raw_desc_xml)
             self.__logger.debug('description xml: {}'.format(self.__desc_xml))
@@ -369,16 +1041,35 @@ class DlnapDevice:
             self.name = _get_friendly_name(self.__desc_xml)
             self.__logger.info('friendlyName: {}'.format(self.name))
 
-            self.control_url = _get_control_url(self.__desc_xml,
-                                                URN_AVTransport)
-            self.__logger.info('control_url: {}'.format(self.control_url))
-
-            self.rendering_control_url = _get_control_url(
-                self.__desc_xml, URN_RenderingControl)
-            self.__logger.info('rendering_control_url: {}'.format(
-                self.rendering_control_url))
+            version, self.control_url = _find_service(
+                self.__desc_xml, URN_AVTransport_Fmt)
+            self.ssdp_version = version or self.ssdp_version
+            self.__logger.info('control_url: {}, version: {}'.format(
+                self.control_url, self.ssdp_version))
+
+            version, self.rendering_control_url = _find_service(
+                self.__desc_xml, URN_RenderingControl_Fmt)
+            self.rendering_control_version = \
+                version or self.rendering_control_version
+            self.__logger.info('rendering_control_url: {}, version: {}'.format(
+                self.rendering_control_url, self.rendering_control_version))
+
+            version, self.content_directory_url = _find_service(
+                self.__desc_xml, URN_ContentDirectory_Fmt)
+            self.content_directory_version = \
+                version or self.content_directory_version
+            self.__logger.info('content_directory_url: {}, version: {}'.format(
+                self.content_directory_url, self.content_directory_version))
+
+            version, self.connection_manager_url = _find_service(
+                self.__desc_xml, URN_ConnectionManager_Fmt)
+            self.connection_manager_version = \
+                version or self.connection_manager_version
+            self.__logger.info('connection_manager_url: {}, version: {}'.format(
+                self.connection_manager_url, self.connection_manager_version))
 
             self.has_av_transport = self.control_url is not None
+            self.has_content_directory = self.content_directory_url is not None
             self.__logger.info('=> Initialization completed'.format(ip))
         except Exception as e:
             self.__logger.warning(
@@ -396,7 +1087,8 @@ class DlnapDevice:
       """
         fields = ''
         for tag, value in data.items():
-            fields += '<{tag}>{value}</{tag}>'.format(tag=tag, value=value)
+            fields += '<{tag}>{value}</{tag}>'.format(
+                tag=tag, value=escape('{}'.format(value)))
 
         payload = """<?xml version="1.0" encoding="utf-8"?>
          <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
@@ -414,17 +1106,36 @@ class DlnapDevice:
 
       action -- control action
       data -- dictionary with XML fields value
+      return -- packet bytes
       """
         if action in ["SetVolume", "SetMute", "GetVolume"]:
             url = self.rendering_control_url
-            urn = URN_RenderingControl_Fmt.format(self.ssdp_version)
+            urn = URN_RenderingControl_Fmt.format(
+                self.rendering_control_version)
+        elif action in [
+                "Browse", "Search", "GetSystemUpdateID",
+                "GetSearchCapabilities", "GetSortCapabilities"
+        ]:
+            url = self.content_directory_url
+            urn = URN_ContentDirectory_Fmt.format(
+                self.content_directory_version)
+        elif action in [
+                "GetProtocolInfo", "GetCurrentConnectionIDs",
+                "GetCurrentConnectionInfo"
+        ]:
+            url = self.connection_manager_url
+            urn = URN_ConnectionManager_Fmt.format(
+                self.connection_manager_version)
         else:
             url = self.control_url
             urn = URN_AVTransport_Fmt.format(self.ssdp_version)
         payload = self._payload_from_template(
             action=action, data=data, urn=urn)
+        self.__logger.debug(payload)
+        payload = payload.encode('utf-8')
 
-        packet = "\r\n".join([
+        # Content-Length is in bytes, not characters
+        header = "\r\n".join([
             'POST {} HTTP/1.1'.format(url),
             'User-Agent: {}/{}'.format(__file__, __version__),
             'Accept: */*',
@@ -434,142 +1145,264 @@ class DlnapDevice:
             'SOAPACTION: "{}#{}"'.format(urn, action),
             'Connection: close',
             '',
-            payload,
+            '',
         ])
 
-        self.__logger.debug(packet)
-        return packet
+        self.__logger.debug(header)
+        return header.encode('utf-8') + payload
 
-    def set_current_media(self, url, instance_id=0):
+    def _call(self, action, data, parse=True):
+        """ Perform control action on device according to call policy.
+
+      action -- control action
+      data -- dictionary with XML fields value
+      parse -- convert response to xml dictionary
+      return -- response xml dictionary or raw response if parse is False
+      """
+        packet = self._create_packet(action, data)
+        raw = self.policy.send((self.ip, self.port), packet, action)
+        if parse or _get_status(raw) != 200:
+            return _parse_response(raw)
+        return raw
+
+    def set_current_media(self, url, instance_id=0, metadata=None):
         """ Set media to playback.
 
       url -- media url
       instance_id -- device instance id
+      metadata -- DIDL-Lite metadata of media, generated from url if None,
+                  '' to let device probe the url
       """
-        packet = self._create_packet('SetAVTransportURI', {
-            'InstanceID': instance_id,
-            'CurrentURI': url,
-            'CurrentURIMetaData': ''
-        })
-        _send_tcp((self.ip, self.port), packet)
+        if metadata is None:
+            metadata = _didl_metadata(url)
+        self._call('SetAVTransportURI',
+                   collections.OrderedDict([('InstanceID', instance_id),
+                                            ('CurrentURI', url),
+                                            ('CurrentURIMetaData', metadata)]))
 
     def play(self, instance_id=0):
         """ Play media that was already set as current.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet('Play', {
+        self._call('Play', {
             'InstanceID': instance_id,
             'Speed': 1
         })
-        _send_tcp((self.ip, self.port), packet)
 
     def pause(self, instance_id=0):
         """ Pause media that is currently playing back.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet('Pause', {
+        self._call('Pause', {
             'InstanceID': instance_id,
             'Speed': 1
         })
-        _send_tcp((self.ip, self.port), packet)
 
     def stop(self, instance_id=0):
         """ Stop media that is currently playing back.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet('Stop', {
+        self._call('Stop', {
             'InstanceID': instance_id,
             'Speed': 1
         })
-        _send_tcp((self.ip, self.port), packet)
 
     def seek(self, position, instance_id=0):
         """
       Seek position
       """
-        packet = self._create_packet('Seek', {
+        self._call('Seek', {
             'InstanceID': instance_id,
             'Unit': 'REL_TIME',
             'Target': position
         })
-        _send_tcp((self.ip, self.port), packet)
+        if self.__poller is not None:
+            self.__poller.notify_seek(position)
 
     def volume(self, volume=10, instance_id=0):
         """ Stop media that is currently playing back.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet(
+        self._call(
             'SetVolume', {
                 'InstanceID': instance_id,
                 'DesiredVolume': volume,
                 'Channel': 'Master'
             })
 
-        _send_tcp((self.ip, self.port), packet)
-
     def get_volume(self, instance_id=0):
         """
       get volume
       """
-        packet = self._create_packet('GetVolume', {
+        return self._call('GetVolume', {
             'InstanceID': instance_id,
             'Channel': 'Master'
         })
-        _send_tcp((self.ip, self.port), packet)
 
     def mute(self, instance_id=0):
         """ Stop media that is currently playing back.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet('SetMute', {
+        self._call('SetMute', {
             'InstanceID': instance_id,
             'DesiredMute': '1',
             'Channel': 'Master'
         })
-        _send_tcp((self.ip, self.port), packet)
 
     def unmute(self, instance_id=0):
         """ Stop media that is currently playing back.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet('SetMute', {
+        self._call('SetMute', {
             'InstanceID': instance_id,
             'DesiredMute': '0',
             'Channel': 'Master'
         })
-        _send_tcp((self.ip, self.port), packet)
 
     def info(self, instance_id=0):
         """ Transport info.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet('GetTransportInfo',
-                                     {'InstanceID': instance_id})
-        return _send_tcp((self.ip, self.port), packet)
+        return self._call('GetTransportInfo', {'InstanceID': instance_id})
 
     def media_info(self, instance_id=0):
         """ Media info.
 
       instance_id -- device instance id
       """
-        packet = self._create_packet('GetMediaInfo',
-                                     {'InstanceID': instance_id})
-        return _send_tcp((self.ip, self.port), packet)
+        return self._call('GetMediaInfo', {'InstanceID': instance_id})
 
     def position_info(self, instance_id=0):
         """ Position info.
       instance_id -- device instance id
       """
-        packet = self._create_packet('GetPositionInfo',
-                                     {'InstanceID': instance_id})
-        return _send_tcp((self.ip, self.port), packet)
+        return self._call('GetPositionInfo', {'InstanceID': instance_id})
+
+    def protocol_info(self):
+        """ Protocols and formats device can send and receive.
+
+      return -- dictionary like
+         { 'source': ['http-get:*:audio/mpeg:*', ..],
+           'sink': ['http-get:*:video/mp4:DLNA.ORG_PN=..', ..] }
+      """
+        xml = self._call('GetProtocolInfo', {})
+        info = {}
+        for field in ('Source', 'Sink'):
+            value = _get_response_value(xml, 'GetProtocolInfo', field)
+            info[field.lower()] = [
+                p.strip() for p in (value or '').split(',') if p.strip()
+            ]
+        return info
+
+    def sink_mime_types(self):
+        """ Mime types renderer accepts over http, '*' if it accepts any.
+
+      return -- list of mime types, empty if device doesn't tell
+      """
+        if self.__sink_protocol_info is None:
+            self.__sink_protocol_info = self.protocol_info()['sink']
+        mime_types = []
+        for protocol in self.__sink_protocol_info:
+            fields = protocol.split(':')
+            if len(fields) == 4 and fields[0] in ('http-get', '*'):
+                mime_types.append(fields[2])
+        return mime_types
+
+    def system_update_id(self):
+        """ Content directory update id, changes on every library change.
+      """
+        xml = self._call('GetSystemUpdateID', {})
+        return _get_response_value(xml, 'GetSystemUpdateID', 'Id')
+
+    def browse(self,
+               object_id='0',
+               browse_flag='BrowseDirectChildren',
+               filter='*',
+               sort_criteria='',
+               page_size=100,
+               cache_items=1000):
+        """ Browse content directory of media server.
+
+      object_id -- id of container to browse, '0' is the root
+      browse_flag -- BrowseDirectChildren or BrowseMetadata
+      filter -- comma separated properties to return, '*' for all
+      sort_criteria -- e.g. '+dc:title'
+      page_size -- objects requested per call
+      cache_items -- containers up to this size are cached until update id changes
+      return -- generator of DIDL-Lite objects, see _didl_object
+      """
+        return self.__paged(
+            'Browse', [('ObjectID', object_id), ('BrowseFlag', browse_flag),
+                       ('Filter', filter)], sort_criteria, page_size,
+            cache_items)
+
+    def search(self,
+               container_id='0',
+               criteria='*',
+               filter='*',
+               sort_criteria='',
+               page_size=100,
+               cache_items=1000):
+        """ Search content directory of media server.
+
+      container_id -- id of container to search in, '0' is the root
+      criteria -- e.g. 'upnp:class derivedfrom "object.item.audioItem"'
+      filter -- comma separated properties to return, '*' for all
+      sort_criteria -- e.g. '+dc:title'
+      page_size -- objects requested per call
+      cache_items -- results up to this size are cached until update id changes
+      return -- generator of DIDL-Lite objects, see _didl_object
+      """
+        return self.__paged(
+            'Search', [('ContainerID', container_id),
+                       ('SearchCriteria', criteria), ('Filter', filter)],
+            sort_criteria, page_size, cache_items)
+
+    def __paged(self, action, args, sort_criteria, page_size, cache_items):
+        """ Yield objects of Browse or Search page by page.
+      """
+        try:
+            update_id = self.system_update_id()
+        except UPnPError:
+            update_id = None
+        key = (action, tuple(args), sort_criteria, update_id)
+        if update_id is not None:
+            cached = self.browse_cache.get(key)
+            if cached is not None:
+                for obj in cached:
+                    yield obj
+                return
+
+        objects = [] if update_id is not None else None
+        start = 0
+        while True:
+            data = collections.OrderedDict(args)
+            data['StartingIndex'] = start
+            data['RequestedCount'] = page_size
+            data['SortCriteria'] = sort_criteria
+            raw = self._call(action, data, parse=False)
+            result, returned, total = _parse_browse_response(raw, action)
+
+            for obj in _iter_didl(result):
+                if objects is not None:
+                    objects.append(obj)
+                    if len(objects) > cache_items:
+                        objects = None
+                yield obj
+
+            start += returned
+            if returned == 0 or (total and start >= total):
+                break
+
+        if objects is not None:
+            self.browse_cache.put(key, objects)
 
     def set_next(self, url):
         pass
@@ -577,6 +1410,1049 @@ class DlnapDevice:
     def next(self):
         pass
 
+    def poller(self, **kwargs):
+        """ Get position and transport state poller of the device.
+
+      kwargs -- DlnapPoller arguments, only allowed when poller is created
+      return -- DlnapPoller shared by all users of the device
+      """
+        if self.__poller is None:
+            self.__poller = DlnapPoller(self, **kwargs)
+        elif kwargs:
+            raise DlnapError('poller of {} is already created, {} would be '
+                             'ignored'.format(self, ', '.join(sorted(kwargs))))
+        return self.__poller
+
+
+class _PendingCall:
+    """ Request that is in flight, shared by all concurrent callers.
+   """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DlnapPoller:
+    """ Polls transport state and position of DlnapDevice.
+
+   Concurrent requests of the same action share one in-flight call and
+   results are cached for 'ttl' seconds. Background polling interval adapts
+   to the transport state and position is interpolated between polls.
+   """
+
+    ACTIONS = {
+        'GetTransportInfo': 'info',
+        'GetPositionInfo': 'position_info',
+        'GetMediaInfo': 'media_info',
+    }
+    IDLE_STATES = ('STOPPED', 'PAUSED_PLAYBACK', 'NO_MEDIA_PRESENT')
+
+    def __init__(self,
+                 device,
+                 instance_id=0,
+                 ttl=0.5,
+                 interval=1,
+                 fast_interval=0.25,
+                 slow_interval=5,
+                 max_interval=30,
+                 near_end=5,
+                 seek_window=3):
+        """ device -- DlnapDevice to poll
+      instance_id -- device instance id
+      ttl -- seconds the result of an action is served from cache
+      interval -- poll interval while playing
+      fast_interval -- poll interval near track end or after seek
+      slow_interval -- poll interval when stopped or paused
+      max_interval -- upper bound of the poll interval while device errors
+      near_end -- seconds before track end to poll fast
+      seek_window -- seconds after seek to poll fast
+      """
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.device = device
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.max_interval = max_interval
+        self.near_end = near_end
+        self.seek_window = seek_window
+
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__cache = {}
+        self.__errors = 0
+        self.__state = None
+        self.__position = None
+        self.__duration = None
+        self.__sampled_at = 0
+        self.__seek_at = 0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def call(self, action):
+        """ Perform action or join the same action that is already in flight.
+
+      action -- one of GetTransportInfo, GetPositionInfo, GetMediaInfo
+      return -- response xml dictionary
+      """
+        with self.__lock:
+            cached = self.__cache.get(action)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                return cached[1]
+            pending = self.__pending.get(action)
+            owner = pending is None
+            if owner:
+                pending = _PendingCall()
+                self.__pending[action] = pending
+
+        if not owner:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            method = getattr(self.device, self.ACTIONS[action])
+            pending.result = method(self.instance_id)
+            sample = self.__sample(action, pending.result)
+        except Exception as e:
+            pending.error = e
+        finally:
+            with self.__lock:
+                del self.__pending[action]
+                if pending.error is None:
+                    self.__cache[action] = (time.time(), pending.result)
+                    self.__update(sample)
+                else:
+                    self.__errors += 1
+            pending.done.set()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def __sample(self, action, xml):
+        """ Extract state or position from response xml.
+
+      return -- dictionary of fields to update
+      """
+        if action == 'GetTransportInfo':
+            return {
+                'state': _get_response_value(xml, action,
+                                             'CurrentTransportState')
+            }
+        if action == 'GetPositionInfo':
+            return {
+                'position': _parse_time(
+                    _get_response_value(xml, action, 'RelTime')),
+                'duration': _parse_time(
+                    _get_response_value(xml, action, 'TrackDuration')) or None
+            }
+        return {}
+
+    def __update(self, sample):
+        """ Remember sampled state and position, called under the lock.
+      """
+        self.__errors = 0
+        now = time.time()
+        if 'state' in sample:
+            if sample['state'] != self.__state:
+                # position keeps going only while playing
+                self.__position = self.__interpolate(now)
+                self.__sampled_at = now
+            self.__state = sample['state']
+        if 'position' in sample:
+            self.__position = sample['position']
+            self.__duration = sample['duration']
+            self.__sampled_at = now
+
+    def transport_state(self):
+        """ Last known transport state, e.g. PLAYING, or None.
+      """
+        return self.__state
+
+    def duration(self):
+        """ Last known track duration in seconds or None.
+      """
+        return self.__duration
+
+    def position(self):
+        """ Current position in seconds interpolated since last poll or None.
+      """
+        with self.__lock:
+            return self.__interpolate(time.time())
+
+    def __interpolate(self, now):
+        if self.__position is None:
+            return None
+        position = self.__position
+        if self.__state == 'PLAYING':
+            position += now - self.__sampled_at
+        if self.__duration is not None:
+            position = min(position, self.__duration)
+        return position
+
+    def rel_time(self):
+        """ Current position as HH:MM:SS string or None.
+      """
+        position = self.position()
+        return _format_time(position) if position is not None else None
+
+    def notify_seek(self, position=None):
+        """ Poll fast for a while after seek.
+
+      position -- target position string, used until next poll
+      """
+        target = _parse_time(position)
+        with self.__lock:
+            self.__seek_at = time.time()
+            if target is not None:
+                self.__position = target
+                self.__sampled_at = self.__seek_at
+            self.__cache.pop('GetPositionInfo', None)
+
+    def next_interval(self):
+        """ Seconds to wait before next poll.
+      """
+        with self.__lock:
+            now = time.time()
+            if self.__errors:
+                return min(self.max_interval,
+                           self.interval * 2**min(self.__errors, 16))
+            if self.__state in self.IDLE_STATES:
+                return self.slow_interval
+            if now - self.__seek_at < self.seek_window:
+                return self.fast_interval
+            position = self.__interpolate(now)
+            if position is not None and self.__duration is not None and \
+                    self.__duration - position <= self.near_end:
+                return self.fast_interval
+            return self.interval
+
+    def poll(self):
+        """ Poll transport state and position once.
+      """
+        for action in ('GetTransportInfo', 'GetPositionInfo'):
+            try:
+                self.call(action)
+            except Exception as e:
+                self.__logger.info('{} poll failed: {}'.format(action, e))
+                break
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.poll()
+            self.__stop.wait(self.next_interval())
+
+    def start(self):
+        """ Start background polling.
+      """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """ Stop background polling.
+      """
+        self.__stop.set()
+
+
+def _which(name):
+    """ Path of executable or None if it can't be found.
+
+   name -- executable name or path
+   """
+    if os.path.dirname(name):
+        return name if os.access(name, os.X_OK) else None
+    extensions = [''] + os.environ.get('PATHEXT', '').split(os.pathsep)
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        for extension in extensions:
+            path = os.path.join(directory, name + extension)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+
+class _TranscodeHandler(BaseHTTPRequestHandler):
+    """ Serves media registered in TranscodeServer.
+   """
+
+    def log_message(self, format, *args):
+        logging.debug('TranscodeServer: ' + format % args)
+
+    def do_HEAD(self):
+        self.__handle(head=True)
+
+    def do_GET(self):
+        self.__handle(head=False)
+
+    def __handle(self, head):
+        owner = self.server.owner
+        entry = owner.entry(self.path.lstrip('/'))
+        if entry is None:
+            self.send_error(404)
+            return
+        source, profile = entry
+
+        if profile is None:
+            self.__send_file(source, mimetypes.guess_type(source)[0] or
+                             'application/octet-stream', head)
+            return
+
+        mime_type = profile[0]
+        cache_path = owner.cache_path(source, profile)
+        if cache_path is not None and os.path.isfile(cache_path):
+            self.__send_file(cache_path, mime_type, head)
+            return
+
+        if head:
+            # probing renderers don't take transcode slots
+            self.__send_stream_headers(mime_type)
+            return
+
+        if not owner.acquire():
+            self.send_error(503, 'Too many transcodes')
+            return
+        try:
+            try:
+                process = owner.spawn(source, profile)
+            except OSError as e:
+                logging.warning('TranscodeServer: ffmpeg failed: {}'.format(e))
+                self.send_error(502, 'Transcoder failed to start')
+                return
+            self.__send_stream_headers(mime_type)
+            owner.transcode(process, cache_path, self.wfile)
+        finally:
+            owner.release()
+
+    def __send_stream_headers(self, mime_type):
+        self.send_response(200)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('transferMode.dlna.org', 'Streaming')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def __send_file(self, path, mime_type, head):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        ranges = re.findall(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if ranges and (ranges[0][0] or ranges[0][1]):
+            if ranges[0][0]:
+                start = int(ranges[0][0])
+                end = int(ranges[0][1]) if ranges[0][1] else end
+            else:
+                start = max(size - int(ranges[0][1]), 0)
+            if start > end or start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, min(end, size - 1), size))
+        else:
+            self.send_response(200)
+        end = min(end, size - 1)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('Content-Length', end - start + 1)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('transferMode.dlna.org', 'Streaming')
+        self.end_headers()
+        if head:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            try:
+                while left > 0:
+                    chunk = f.read(min(self.server.owner.chunk_size, left))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    left -= len(chunk)
+            except (socket.error, IOError):
+                # renderer closed connection, e.g. on seek
+                pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TranscodeServer:
+    """ HTTP server that streams media to renderers in a format they accept.
+
+   Format is chosen from the renderer's ConnectionManager sink protocols.
+   Media renderer doesn't accept is piped through ffmpeg, writes to the
+   renderer block ffmpeg when renderer reads slowly. Completely converted
+   media is cached, so repeat plays are served from disk.
+   """
+
+    def __init__(self,
+                 port=8000,
+                 max_transcodes=2,
+                 cache_dir=None,
+                 ffmpeg='ffmpeg',
+                 profiles=None,
+                 chunk_size=64 * 1024):
+        """ port -- port to listen on
+      max_transcodes -- ffmpeg processes allowed at the same time
+      cache_dir -- directory of converted media, '' disables cache
+      ffmpeg -- ffmpeg executable
+      profiles -- formats to convert to, default TRANSCODE_PROFILES
+      chunk_size -- bytes read from ffmpeg at once
+      """
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.port = port
+        self.ffmpeg = ffmpeg
+        self.profiles = profiles if profiles is not None else TRANSCODE_PROFILES
+        self.chunk_size = chunk_size
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'dlnap-cache')
+        self.cache_dir = cache_dir
+
+        self.__slots = threading.BoundedSemaphore(max_transcodes)
+        self.__entries = {}
+        self.__server = None
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """ Start serving in background thread, safe to call concurrently.
+      """
+        with self.__lock:
+            if self.__server is not None:
+                return
+            self.__server = _ThreadingHTTPServer(('', self.port),
+                                                 _TranscodeHandler)
+            self.__server.owner = self
+            self.port = self.__server.server_address[1]
+            thread = threading.Thread(target=self.__server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        self.__logger.info('listening on port {}'.format(self.port))
+
+    def stop(self):
+        """ Stop serving.
+      """
+        with self.__lock:
+            if self.__server is not None:
+                self.__server.shutdown()
+                self.__server.server_close()
+                self.__server = None
+
+    def choose_profile(self, device, mime_type):
+        """ Choose format to convert media to for device.
+
+      device -- DlnapDevice to play media on
+      mime_type -- mime type of media
+      return -- profile from profiles or None if no conversion is needed
+      """
+        try:
+            accepted = device.sink_mime_types()
+        except DlnapError as e:
+            self.__logger.warning('{}: {}'.format(device, e))
+            accepted = []
+        if not accepted or '*' in accepted or mime_type in accepted:
+            return None
+
+        major = (mime_type or '').split('/')[0]
+        for profile in self.profiles:
+            if profile[0].split('/')[0] == major and profile[0] in accepted:
+                return profile
+        self.__logger.warning('{} accepts no known format for {}'.format(
+            device, mime_type))
+        return None
+
+    def serve(self, device, source, title=None):
+        """ Make media playable on device.
+
+      device -- DlnapDevice to play media on
+      source -- media url or local file path
+      title -- media title
+      return -- (url, metadata) pair to pass to set_current_media
+      """
+        name = unquote(os.path.basename(urlparse(source).path))
+        mime_type = mimetypes.guess_type(name)[0]
+        profile = self.choose_profile(device, mime_type)
+        if profile is not None and _which(self.ffmpeg) is None:
+            self.__logger.warning('{} not found, {} is served as is'.format(
+                self.ffmpeg, source))
+            profile = None
+        local = os.path.isfile(source)
+        if profile is None and not local:
+            return source, _didl_metadata(source, title=title)
+
+        self.start()
+        extension = profile[1] if profile else os.path.splitext(name)[1]
+        token = hashlib.sha1('{}|{}'.format(source, profile).encode(
+            'utf-8')).hexdigest()[:16] + extension
+        self.__entries[token] = (source, profile)
+        url = 'http://{}:{}/{}'.format(
+            _get_serve_ip(device.ip, device.port or 80), self.port, token)
+
+        # converted media supports range requests once it is cached
+        seekable = profile is None
+        if not seekable:
+            cache_path = self.cache_path(source, profile)
+            seekable = cache_path is not None and os.path.isfile(cache_path)
+        metadata = _didl_metadata(
+            url,
+            path=source if profile is None else None,
+            title=title or os.path.splitext(name)[0],
+            mime_type=profile[0] if profile else mime_type,
+            seekable=seekable)
+        return url, metadata
+
+    def entry(self, token):
+        """ (source, profile) registered for token or None.
+      """
+        return self.__entries.get(token)
+
+    def cache_path(self, source, profile):
+        """ Path of converted media in cache or None if cache is disabled.
+      """
+        if not self.cache_dir:
+            return None
+        key = source
+        if os.path.isfile(source):
+            st = os.stat(source)
+            key += '|{}|{}'.format(st.st_size, st.st_mtime)
+        key += '|{}'.format(profile)
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest() +
+                            profile[1])
+
+    def acquire(self):
+        return self.__slots.acquire(False)
+
+    def release(self):
+        self.__slots.release()
+
+    def spawn(self, source, profile):
+        """ Start ffmpeg converting media to its stdout.
+
+      source -- media url or local file path
+      profile -- (mime type, extension, ffmpeg arguments)
+      return -- ffmpeg process, raises OSError if it fails to start
+      """
+        command = [self.ffmpeg, '-nostdin', '-loglevel', 'error', '-i', source
+                   ] + profile[2] + ['pipe:1']
+        self.__logger.info(' '.join(command))
+        devnull = open(os.devnull, 'wb')
+        try:
+            return subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=devnull)
+        finally:
+            devnull.close()
+
+    def transcode(self, process, cache_path, out):
+        """ Pipe media converted by ffmpeg to out.
+
+      process -- ffmpeg process started by spawn
+      cache_path -- file to keep converted media in or None
+      out -- file like object to write converted media to
+      """
+        cache = None
+        if cache_path is not None:
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by concurrent request
+                if not os.path.isdir(self.cache_dir):
+                    raise
+            # every request writes its own partial file, so an aborted
+            # request can't remove the file another one is writing
+            fd, partial = tempfile.mkstemp(
+                suffix='.part', dir=self.cache_dir)
+            cache = os.fdopen(fd, 'wb')
+
+        completed = False
+        try:
+            while True:
+                chunk = process.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                out.write(chunk)
+                if cache is not None:
+                    cache.write(chunk)
+            completed = process.wait() == 0
+        except (socket.error, IOError) as e:
+            self.__logger.info('renderer stopped reading: {}'.format(e))
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            if cache is not None:
+                cache.close()
+                if completed:
+                    os.rename(partial, cache_path)
+                else:
+                    os.remove(partial)
+
+
+class BulkResult:
+    """ Result of action performed on one device by BulkOperation.
+   """
+
+    def __init__(self, device, value=None, error=None, elapsed=0.0):
+        """ device -- DlnapDevice
+      value -- value returned by action
+      error -- exception raised by action or DeadlineExceeded
+      elapsed -- seconds from operation start
+      """
+        self.device = device
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '{} {}'.format(self.device, 'ok' if self.ok else self.error)
+
+
+class BulkOperation:
+    """ Performs DlnapDevice action on many devices at once.
+
+   At most 'concurrency' devices are called at the same time. Results are
+   yielded as soon as devices respond, devices that didn't respond before
+   'deadline' are reported with DeadlineExceeded, so a sweep takes about as
+   long as the slowest responding device.
+
+      for result in BulkOperation(devices, 'volume', args=(20,)):
+         print(result)
+   """
+
+    def __init__(self,
+                 devices,
+                 action,
+                 args=(),
+                 kwargs=None,
+                 concurrency=16,
+                 deadline=30,
+                 predicate=None):
+        """ devices -- list of DlnapDevice
+      action -- DlnapDevice method name or callable taking device
+      args -- positional arguments of method
+      kwargs -- keyword arguments of method
+      concurrency -- devices called at the same time
+      deadline -- seconds for the whole operation
+      predicate -- callable selecting devices to perform the action on
+      """
+        self.devices = [d for d in devices if predicate is None or predicate(d)]
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.summary = {
+            'total': len(self.devices),
+            'ok': 0,
+            'failed': 0,
+            'timed_out': 0,
+            'errors': {},
+            'elapsed': 0.0
+        }
+
+    def __perform(self, device):
+        if callable(self.action):
+            return self.action(device)
+        return getattr(device, self.action)(*self.args, **self.kwargs)
+
+    def __worker(self, tasks, results, start, deadline):
+        while time.time() < deadline:
+            try:
+                device = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                value = self.__perform(device)
+                results.put(
+                    BulkResult(device, value=value, elapsed=time.time() - start))
+            except Exception as e:
+                results.put(
+                    BulkResult(device, error=e, elapsed=time.time() - start))
+
+    def __count(self, result):
+        if result.ok:
+            self.summary['ok'] += 1
+            return
+        if isinstance(result.error, DeadlineExceeded):
+            self.summary['timed_out'] += 1
+        else:
+            self.summary['failed'] += 1
+        name = result.error.__class__.__name__
+        self.summary['errors'][name] = self.summary['errors'].get(name, 0) + 1
+
+    def __iter__(self):
+        start = time.time()
+        deadline = start + self.deadline
+        tasks = queue.Queue()
+        for device in self.devices:
+            tasks.put(device)
+        results = queue.Queue()
+        for i in range(min(self.concurrency, len(self.devices))):
+            worker = threading.Thread(
+                target=self.__worker, args=(tasks, results, start, deadline))
+            # workers stuck on a device must not block exit
+            worker.daemon = True
+            worker.start()
+
+        pending = dict((id(d), d) for d in self.devices)
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                result = results.get(timeout=remaining)
+            except queue.Empty:
+                break
+            del pending[id(result.device)]
+            self.__count(result)
+            yield result
+
+        for device in self.devices:
+            if id(device) in pending:
+                result = BulkResult(
+                    device,
+                    error=DeadlineExceeded('no response in {} s'.format(
+                        self.deadline)),
+                    elapsed=time.time() - start)
+                self.__count(result)
+                yield result
+        self.summary['elapsed'] = time.time() - start
+
+
+class SessionRecorder:
+    """ Appends every SSDP and SOAP exchange to a file.
+
+   Every exchange is one json line, bytes are stored as latin-1 strings:
+      {"t": start time, "k": "soap" | "ssdp" | "ssdp-response",
+       "a": "host:port", "d": duration, "q": request, "r": response,
+       "e": error}
+   Recording is opt-in: nothing is logged until start() is called.
+   """
+
+    def __init__(self, path):
+        """ path -- file to append exchanges to
+      """
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__file = None
+
+    def start(self):
+        """ Record exchanges of all devices until stop().
+      """
+        global _recorder
+        with self.__lock:
+            if self.__file is None:
+                self.__file = open(self.path, 'ab')
+        _recorder = self
+
+    def stop(self):
+        global _recorder
+        if _recorder is self:
+            _recorder = None
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def record(self,
+               kind,
+               to,
+               request,
+               response=b'',
+               started=None,
+               error=None):
+        """ Append exchange to the file.
+
+      kind -- soap, ssdp or ssdp-response
+      to -- (host, port) of the other side
+      request -- bytes sent
+      response -- bytes received
+      started -- time the exchange started, now if None
+      error -- exception the exchange failed with
+      """
+        now = time.time()
+        entry = {
+            't': round(now if started is None else started, 6),
+            'k': kind,
+            'a': '{}:{}'.format(to[0], to[1]),
+        }
+        if request:
+            entry['q'] = bytes(request).decode('latin-1')
+        if response:
+            entry['r'] = bytes(response).decode('latin-1')
+        if started is not None:
+            entry['d'] = round(now - started, 6)
+        if error is not None:
+            entry['e'] = str(error)
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.write(line.encode('utf-8'))
+                self.__file.flush()
+
+
+def _load_session(path):
+    """ Read exchanges written by SessionRecorder.
+
+   path -- recorded session file
+   return -- generator of entries with 'q' and 'r' as bytes
+   """
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line.decode('utf-8'))
+            entry['q'] = entry.get('q', '').encode('latin-1')
+            entry['r'] = entry.get('r', '').encode('latin-1')
+            yield entry
+
+
+def _parse_address(address):
+    """ Convert 'host:port' to (host, port).
+   """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _percentiles(values):
+    """ p50, p90, p99 and max of seconds in milliseconds.
+   """
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(p):
+        return values[min(len(values) - 1, int(p * len(values)))] * 1000
+
+    return {
+        'p50': at(0.5),
+        'p90': at(0.9),
+        'p99': at(0.99),
+        'max': values[-1] * 1000
+    }
+
+
+class _StubRendererHandler(BaseHTTPRequestHandler):
+    """ Answers SOAP requests with recorded responses.
+   """
+
+    def log_message(self, format, *args):
+        logging.debug('StubRenderer: ' + format % args)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        action = self.headers.get('SOAPACTION', '').strip('"')
+        response, duration = self.server.owner.response(action)
+        if response is None:
+            self.send_error(501, 'No recorded response for {}'.format(action))
+            return
+        if duration:
+            time.sleep(duration)
+        self.wfile.write(response)
+        self.close_connection = True
+
+
+class StubRenderer:
+    """ Local renderer replaying responses recorded by SessionRecorder.
+   """
+
+    def __init__(self, exchanges, port=0, delay=False):
+        """ exchanges -- recorded soap entries of one device
+      port -- port to listen on, any free port if 0
+      delay -- respond after recorded device duration
+      """
+        self.port = port
+        self.delay = delay
+        self.__lock = threading.Lock()
+        self.__responses = {}
+        for entry in exchanges:
+            if entry['r']:
+                action = _get_header(entry['q'], 'soapaction').strip('"')
+                self.__responses.setdefault(action, []).append(
+                    (entry['r'], entry.get('d', 0)))
+        self.__turns = {}
+        self.__server = None
+
+    def response(self, action):
+        """ Next recorded (response, duration) of action, in turn.
+      """
+        responses = self.__responses.get(action)
+        if not responses:
+            return None, 0
+        with self.__lock:
+            turn = self.__turns.get(action, 0)
+            self.__turns[action] = turn + 1
+        response, duration = responses[turn % len(responses)]
+        return response, duration if self.delay else 0
+
+    def start(self):
+        self.__server = _ThreadingHTTPServer(('127.0.0.1', self.port),
+                                             _StubRendererHandler)
+        self.__server.owner = self
+        self.port = self.__server.server_address[1]
+        thread = threading.Thread(target=self.__server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+
+class SessionReplay:
+    """ Re-drives session recorded by SessionRecorder.
+
+   Requests are sent at their recorded pace divided by 'speed', against
+   the recorded devices, addresses in 'targets' or local StubRenderers.
+   """
+
+    def __init__(self,
+                 path,
+                 speed=1.0,
+                 targets=None,
+                 stub=False,
+                 concurrency=32,
+                 timeout=5):
+        """ path -- recorded session file
+      speed -- 2 replays twice as fast as recorded
+      targets -- dictionary of recorded 'host:port' to (host, port) to send to
+      stub -- answer soap requests by local StubRenderers
+      concurrency -- requests in flight at the same time
+      timeout -- connect and read timeout of soap requests
+      """
+        self.path = path
+        self.speed = speed
+        self.targets = dict(targets or {})
+        self.stub = stub
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def __send(self, entry, latencies, errors):
+        address = entry['a']
+        kind = entry['k']
+        to = self.targets.get(address) or _parse_address(address)
+        started = time.time()
+        try:
+            if kind == 'ssdp':
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                     socket.IPPROTO_UDP)
+                try:
+                    sock.sendto(entry['q'], to)
+                finally:
+                    sock.close()
+            else:
+                _send_tcp(to, entry['q'], self.timeout, self.timeout)
+            latencies[kind].append(time.time() - started)
+        except Exception as e:
+            logging.info('replay {} failed: {}'.format(address, e))
+            errors[kind].append(e)
+
+    def __worker(self, tasks, latencies, errors, lags):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            due, entry = task
+            lags.append(max(time.time() - due, 0))
+            self.__send(entry, latencies, errors)
+
+    def run(self):
+        """ Replay the session.
+
+      Discovery packets are not replayed against stubs, they would reach
+      real devices on the network.
+
+      return -- report dictionary like
+         { 'requests': 120, 'errors': 0, 'elapsed': 10.2, 'throughput': 11.7,
+           'skipped': 0, 'max_lag': 0.001,
+           'soap': {'requests': 118, 'errors': 0,
+                    'latency': {'p50': 12.0, 'p90': .., 'p99': .., 'max': ..},
+                    'recorded_latency': {..}},
+           'ssdp': {'requests': 2, 'errors': 0, 'latency': {..}} }
+         latencies are in milliseconds, ssdp latency is the time to send
+      """
+        entries = sorted(
+            (e for e in _load_session(self.path)
+             if e['k'] in ('soap', 'ssdp') and e['q']),
+            key=lambda e: e['t'])
+        skipped = 0
+        if self.stub:
+            skipped = len([e for e in entries if e['k'] == 'ssdp'])
+            entries = [e for e in entries if e['k'] == 'soap']
+
+        stubs = []
+        if self.stub:
+            exchanges = {}
+            for entry in entries:
+                exchanges.setdefault(entry['a'], []).append(entry)
+            for address, device_exchanges in exchanges.items():
+                stub = StubRenderer(device_exchanges, delay=True)
+                stub.start()
+                stubs.append(stub)
+                self.targets[address] = ('127.0.0.1', stub.port)
+
+        latencies = {'soap': [], 'ssdp': []}
+        errors = {'soap': [], 'ssdp': []}
+        lags = []
+        tasks = queue.Queue()
+        workers = []
+        for i in range(self.concurrency):
+            worker = threading.Thread(
+                target=self.__worker, args=(tasks, latencies, errors, lags))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        start = time.time()
+        first = entries[0]['t'] if entries else 0
+        try:
+            for entry in entries:
+                due = start + (entry['t'] - first) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                tasks.put((due, entry))
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+            elapsed = time.time() - start
+            for stub in stubs:
+                stub.stop()
+
+        report = {
+            'requests': len(entries),
+            'errors': len(errors['soap']) + len(errors['ssdp']),
+            'elapsed': elapsed,
+            'throughput': len(entries) / elapsed if elapsed else 0,
+            'skipped': skipped,
+            'max_lag': max(lags) if lags else 0,
+        }
+        for kind in ('soap', 'ssdp'):
+            report[kind] = {
+                'requests': len([e for e in entries if e['k'] == kind]),
+                'errors': len(errors[kind]),
+                'latency': _percentiles(latencies[kind]),
+            }
+        report['soap']['recorded_latency'] = _percentiles(
+            [e['d'] for e in entries if e['k'] == 'soap' and 'd' in e])
+        return report
+
 
 #
 # Signal of Ctrl+C
@@ -626,10 +2502,23 @@ class Cli():
     action = ''
     logLevel = logging.WARN
     compatibleOnly = True
+    mediaServers = False
+    transcode = False
+    transcode_port = 8000
+    max_transcodes = 2
+    transcode_server = None
+    object_id = '0'
     ip = ''
     ssdp_version = 1
     devices = []
     device_index = 0
+    bulk = False
+    recorder = None
+    session = ''
+    speed = 1.0
+    stub = False
+    concurrency = 16
+    deadline = 30
 
     def discover(self,
                  name='',
@@ -642,44 +2531,62 @@ class Cli():
 
     name -- name or part of the name to filter devices
     timeout -- timeout to perform discover
-    st -- st field of discovery packet
+    st -- st field or list of st fields of discovery packets
     mx -- mx field of discovery packet
+    ssdp_version -- version or list of versions to format st fields with
     return -- list of DlnapDevice
     """
-        st = st.format(ssdp_version)
-        payload = "\r\n".join([
-            'M-SEARCH * HTTP/1.1', 'User-Agent: {}/{}'.format(
-                __file__, __version__), 'HOST: {}:{}'.format(*SSDP_GROUP),
-            'Accept: */*', 'MAN: "ssdp:discover"', 'ST: {}'.format(st),
-            'MX: {}'.format(mx), '', ''
-        ])
-        with _send_udp(SSDP_GROUP, payload) as sock:
+        sts = st if isinstance(st, (list, tuple)) else [st]
+        versions = ssdp_version if isinstance(ssdp_version,
+                                              (list, tuple)) else [ssdp_version]
+        targets = []
+        for st in sts:
+            for version in versions:
+                if st.format(version) not in targets:
+                    targets.append(st.format(version))
+
+        payloads = [
+            "\r\n".join([
+                'M-SEARCH * HTTP/1.1', 'User-Agent: {}/{}'.format(
+                    __file__, __version__), 'HOST: {}:{}'.format(*SSDP_GROUP),
+                'Accept: */*', 'MAN: "ssdp:discover"', 'ST: {}'.format(target),
+                'MX: {}'.format(mx), '', ''
+            ]).encode() for target in targets
+        ]
+
+        # responses to all targets are merged by device uuid, so every device
+        # description is fetched once
+        found = collections.OrderedDict()
+        with _send_udp(SSDP_GROUP, payloads) as sock:
             start = time.time()
             try:
                 while True:
-                    if time.time() - start > timeout:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
                         # timed out
                         break
-                    r, w, x = select.select([sock], [], [sock], 1)
+                    r, w, x = select.select([sock], [], [sock], remaining)
                     if sock in r:
-                        data, addr = sock.recvfrom(1024)
+                        data, addr = sock.recvfrom(4096)
+                        if _recorder is not None:
+                            _recorder.record('ssdp-response', addr, b'', data)
                         if ip and addr[0] != ip:
                             continue
 
-                        d = DlnapDevice(data, addr[0])
-                        d.ssdp_version = ssdp_version
-                        if d not in self.devices:
-                            if not name or name is None or name.lower(
-                            ) in d.name.lower():
-
-                                self.devices.append(d)
-                                print('{} {}'.format(self.devices.index(d), d))
-                                if not ip:
-                                    pass
-                                elif d.has_av_transport:
-                                    # no need in further searching by ip
-                                    break
-
+                        location = _get_location_url(data)
+                        if not location:
+                            continue
+                        key = _get_header(data, 'usn').split('::')[0] or location
+                        target = _get_header(data, 'st')
+                        if key not in found:
+                            found[key] = [data, addr[0], None]
+                        version = _get_service_version(target)
+                        if version is not None and target.startswith(
+                                URN_AVTransport_Fmt.format('')):
+                            found[key][2] = max(found[key][2] or 0, version)
+                            if ip:
+                                # no need in further searching by ip
+                                break
                     elif sock in x:
                         raise Exception('Getting response failed')
                     else:
@@ -688,6 +2595,34 @@ class Cli():
             except KeyboardInterrupt:
                 pass
 
+        # descriptions are fetched after the receive loop and in parallel, so
+        # a slow description server delays neither responses nor other devices
+        devices = collections.OrderedDict()
+
+        def describe(key, data, addr):
+            devices[key] = DlnapDevice(data, addr)
+
+        threads = []
+        for key, reply in found.items():
+            thread = threading.Thread(
+                target=describe, args=(key, reply[0], reply[1]))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for key, reply in found.items():
+            d = devices[key]
+            version = reply[2]
+            if version is not None:
+                d.ssdp_version = max(d.ssdp_version, version)
+            if d in self.devices:
+                continue
+            if not name or name.lower() in d.name.lower():
+                self.devices.append(d)
+                print('{} {}'.format(self.devices.index(d), d))
+
     def usage(self):
         print(
             '{} [--search <timeout>] [--index <index of device>] [--ip <device ip>] [-d[evice] <name>] [--all] [-t[imeout] <seconds>] [--play <url>] [--pause] [--stop]'.
@@ -719,8 +2654,40 @@ class Cli():
             ' --seek <position in HH:MM:SS> - set current position for playback'
         )
         print(
-            ' --ssdp-version <version> - discover devices by protocol version, default 1'
+            ' --ssdp-version <version>[,<version>...] - discover devices by protocol versions, default 1'
         )
+        print(
+            ' --media-servers - flag to discover media servers along with compatible devices'
+        )
+        print(
+            ' --browse <object id> - list content of media server container, default is the root'
+        )
+        print(
+            ' --transcode - convert media to a format the device accepts, local files can be played as well'
+        )
+        print(
+            ' --transcode-port <port> - port to serve converted media on, default 8000'
+        )
+        print(
+            ' --max-transcodes <count> - ffmpeg processes allowed at the same time, default 2'
+        )
+        print(
+            ' --bulk - perform command on all discovered devices, filtered by --device'
+        )
+        print(
+            ' --concurrency <count> - devices called at the same time by --bulk, default 16'
+        )
+        print(
+            ' --deadline <seconds> - time limit of --bulk command, default 30'
+        )
+        print(
+            ' --record <file> - append every SSDP and SOAP exchange to the file'
+        )
+        print(
+            ' --replay <file> - replay recorded session and report throughput and latency'
+        )
+        print(' --speed <factor> - replay speed, default 1')
+        print(' --stub - replay against local stub renderers')
         print(' --help - this help')
 
     def version(self):
@@ -744,10 +2711,30 @@ class Cli():
                     self.logLevel = logging.WARN
             elif opt in ('--all'):
                 self.compatibleOnly = False
+            elif opt in ('--media-servers'):
+                self.mediaServers = True
+            elif opt in ('--record'):
+                if self.recorder is not None:
+                    self.recorder.stop()
+                self.recorder = SessionRecorder(arg)
+                self.recorder.start()
+            elif opt in ('--replay'):
+                self.action = 'replay'
+                self.session = arg
+            elif opt in ('--speed'):
+                self.speed = float(arg)
+            elif opt in ('--stub'):
+                self.stub = True
+            elif opt in ('--bulk'):
+                self.bulk = True
+            elif opt in ('--concurrency'):
+                self.concurrency = int(arg)
+            elif opt in ('--deadline'):
+                self.deadline = float(arg)
             elif opt in ('-d', '--device'):
                 self.device = arg
             elif opt in ('--ssdp-version'):
-                self.ssdp_version = int(arg)
+                self.ssdp_version = [int(v) for v in arg.split(',')]
             elif opt in ('--index', 'I'):
                 self.device_index = int(arg)
             elif opt in ('-i', '--ip'):
@@ -777,6 +2764,65 @@ class Cli():
                 self.action = 'info'
             elif opt in ('--media-info'):
                 self.action = 'media-info'
+            elif opt in ('--transcode'):
+                self.transcode = True
+            elif opt in ('--transcode-port'):
+                self.transcode_port = int(arg)
+            elif opt in ('--max-transcodes'):
+                self.max_transcodes = int(arg)
+            elif opt in ('--browse'):
+                self.action = 'browse'
+                self.object_id = arg or '0'
+
+    def transcoder(self):
+        """ TranscodeServer started on first use.
+      """
+        if self.transcode_server is None:
+            self.transcode_server = TranscodeServer(
+                port=self.transcode_port, max_transcodes=self.max_transcodes)
+        return self.transcode_server
+
+    def perform(self, d):
+        """ Perform current action on device.
+
+    d -- DlnapDevice to perform the action on
+    return -- info requested by the action
+    """
+        if self.action == 'play':
+            if self.url != '':
+                url, metadata = self.url, None
+                if self.transcode:
+                    url, metadata = self.transcoder().serve(d, self.url)
+                try:
+                    d.stop()
+                except UPnPError as e:
+                    # e.g. 701 Transition not available when nothing plays
+                    logging.info('{} ignored stop fault: {}'.format(d, e))
+                d.set_current_media(url=url, metadata=metadata)
+                d.play()
+            else:
+                d.play()
+        elif self.action == 'pause':
+            d.pause()
+        elif self.action == 'stop':
+            d.stop()
+        elif self.action == 'volume':
+            d.volume(self.vol)
+        elif self.action == 'seek':
+            d.seek(self.position)
+        elif self.action == 'mute':
+            d.mute()
+        elif self.action == 'unmute':
+            d.unmute()
+        elif self.action == 'info':
+            return d.info()
+        elif self.action == 'media-info':
+            return d.media_info()
+        elif self.action == 'browse':
+            for obj in d.browse(self.object_id):
+                print('{} {} {}'.format('[c]' if obj['type'] == 'container'
+                                        else '[i]', obj.get('id'),
+                                        obj.get('title')))
 
     def run(self):
         run = True
@@ -791,7 +2837,9 @@ class Cli():
 
             logging.basicConfig(level=self.logLevel)
 
-            st = URN_AVTransport_Fmt if self.compatibleOnly else SSDP_ALL
+            st = [URN_AVTransport_Fmt] if self.compatibleOnly else [SSDP_ALL]
+            if self.compatibleOnly and self.mediaServers:
+                st.append(URN_MediaServer_Fmt)
 
             # print(self.action)
             if self.action == 'search':
@@ -806,8 +2854,12 @@ class Cli():
                 print('Discovered devices:')
                 for d in self.devices:
                     print('{} {} {}'.format(
-                        self.device_index, '[a]'
-                        if d.has_av_transport else '[x]', d))
+                        self.device_index, '[a]' if d.has_av_transport else
+                        '[m]' if d.has_content_directory else '[x]', d))
+
+            if self.action == 'replay':
+                self.replay()
+                continue
 
             if not self.devices:
                 print('No compatible devices found.')
@@ -822,35 +2874,67 @@ class Cli():
                     ['youtube-dl', '-g', url], stdout=subprocess.PIPE)
                 url, err = process.communicate()
 
-            if self.action == 'play':
-                try:
-                    if self.url != '':
-                        d.stop()
-                        d.set_current_media(url=self.url)
-                        d.play()
-                    else:
-                        d.play()
-                except Exception as e:
+            if self.bulk and self.action not in (None, 'search', 'list'):
+                self.perform_bulk()
+                continue
+
+            try:
+                value = self.perform(d)
+                if value is not None:
+                    print(value)
+            except Exception as e:
+                if self.action == 'play':
                     print('Device is unable to play media.')
                     logging.warn('Play exception:\n{}'.format(
                         traceback.format_exc()))
-            elif self.action == 'pause':
-                d.pause()
-            elif self.action == 'stop':
-                d.stop()
-            elif self.action == 'volume':
-                d.volume(self.vol)
-            elif self.action == 'seek':
-                d.seek(self.position)
-            elif self.action == 'mute':
-                d.mute()
-            elif self.action == 'unmute':
-                d.unmute()
-            elif self.action == 'info':
-                print(d.info())
-            elif self.action == 'media-info':
-                print(d.media_info())
-
-
-cli = Cli()
-cli.run()
+                elif isinstance(e, DlnapError):
+                    print('{}: {}'.format(d, e))
+                else:
+                    raise
+
+    def replay(self):
+        """ Replay recorded session and print report.
+    """
+        report = SessionReplay(
+            self.session, speed=self.speed, stub=self.stub).run()
+        print('{} requests in {:.1f} s, {:.1f} requests/s, {} errors'.format(
+            report['requests'], report['elapsed'], report['throughput'],
+            report['errors']))
+        if report['skipped']:
+            print('{} ssdp requests skipped, stubs only answer soap'.format(
+                report['skipped']))
+        for kind, name in (('soap', 'latency'), ('soap', 'recorded_latency'),
+                           ('ssdp', 'latency')):
+            value = report[kind][name]
+            if value:
+                print('{} {} ms: p50 {:.1f} p90 {:.1f} p99 {:.1f} max {:.1f}'.
+                      format(kind, name.replace('_', ' '), value['p50'],
+                             value['p90'], value['p99'], value['max']))
+
+    def perform_bulk(self):
+        """ Perform current action on all discovered devices matching name.
+    """
+        name = self.device.lower() if self.device else ''
+        if self.action == 'play' and self.transcode:
+            # one server for the whole sweep, not one per worker
+            self.transcoder().start()
+        operation = BulkOperation(
+            self.devices,
+            self.perform,
+            concurrency=self.concurrency,
+            deadline=self.deadline,
+            predicate=lambda d: name in d.name.lower())
+        for result in operation:
+            if result.ok and result.value is not None:
+                print('{} {}'.format(result.device, result.value))
+            else:
+                print(result)
+        summary = operation.summary
+        print('{} devices: {} ok, {} failed, {} timed out in {:.1f} s'.format(
+            summary['total'], summary['ok'], summary['failed'],
+            summary['timed_out'], summary['elapsed']))
+
+
+if __name__ == '__main__':
+    cli = Cli()
+    cli.run()